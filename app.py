@@ -1,18 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, jsonify, g, has_app_context
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
 from googleapiclient.discovery import build
-from wtforms import IntegerField, FloatField, SubmitField, SelectField
+from googleapiclient.errors import HttpError
+from wtforms import IntegerField, FloatField, SubmitField, SelectField, HiddenField
 from wtforms.validators import DataRequired, NumberRange, InputRequired
 from flask_wtf import FlaskForm
 from collections import defaultdict
 from flask_wtf.csrf import CSRFProtect
+from functools import wraps
 import os
 import base64
+import fcntl
+import gzip
+import hashlib
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import zlib
+from array import array
 from dotenv import load_dotenv
 import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import MinMaxScaler
 import joblib
+import httplib2
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import retrain
+import google_auth_httplib2
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 csrf = CSRFProtect(app)
@@ -22,117 +46,575 @@ app.config['SECRET_KEY'] = 'vedant363'
 # Load environment variables from .env file
 load_dotenv()
 
-# Decode the Base64 encoded credentials
-encoded_credentials = os.getenv('ENCODED_CREDENTIALS')
-decoded_credentials = base64.b64decode(encoded_credentials)
-
-# Save the decoded credentials to a temporary file
-with open('temp_credentials.json', 'wb') as f:
-    f.write(decoded_credentials)
+# Optional Sheets API endpoint override, used to run against the local
+# stand-in server in loadtest.py instead of Google
+SHEETS_API_ENDPOINT = os.getenv('SHEETS_API_ENDPOINT')
 
 # Define the scopes required for the Google Sheets API (read and write)
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
-# Use service account credentials to authenticate
-creds = service_account.Credentials.from_service_account_file(
-    'temp_credentials.json', scopes=SCOPES)
+if SHEETS_API_ENDPOINT:
+    # The stand-in server does not check credentials
+    creds = AnonymousCredentials()
+else:
+    # Decode the Base64 encoded credentials
+    encoded_credentials = os.getenv('ENCODED_CREDENTIALS')
+    decoded_credentials = base64.b64decode(encoded_credentials)
+
+    # Save the decoded credentials to a temporary file
+    with open('temp_credentials.json', 'wb') as f:
+        f.write(decoded_credentials)
+
+    # Use service account credentials to authenticate
+    creds = service_account.Credentials.from_service_account_file(
+        'temp_credentials.json', scopes=SCOPES)
 
 # The ID of the Google Sheet from the environment variable
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 
+# Function to build the Google Sheets API service
+def build_sheets_service():
+    client_options = {'api_endpoint': SHEETS_API_ENDPOINT} if SHEETS_API_ENDPOINT else None
+    return build('sheets', 'v4', credentials=creds, client_options=client_options)
+
 # Build the Google Sheets API service
-service = build('sheets', 'v4', credentials=creds)
+service = build_sheets_service()
 sheet = service.spreadsheets()
 
 # Specify only the sheet name to dynamically fetch all data
 RANGE_NAME = 'sheet1'
 
+# Per-minute Sheets API quotas for the whole app (the default per-user quota is 60)
+SHEETS_READS_PER_MINUTE = int(os.getenv('SHEETS_READS_PER_MINUTE', 60))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', 60))
+
+# The quota is shared by every gunicorn worker, so each worker's limiter gets an
+# equal slice. gunicorn and Heroku take the worker count from WEB_CONCURRENCY.
+SHEETS_WORKERS = max(int(os.getenv('WEB_CONCURRENCY', 1)), 1)
+SHEETS_READS_PER_MINUTE_PER_WORKER = max(SHEETS_READS_PER_MINUTE // SHEETS_WORKERS, 1)
+SHEETS_WRITES_PER_MINUTE_PER_WORKER = max(SHEETS_WRITES_PER_MINUTE // SHEETS_WORKERS, 1)
+
+# Retry and circuit breaker settings for Sheets calls
+SHEETS_MAX_RETRIES = 4
+SHEETS_BACKOFF_BASE = 0.5
+SHEETS_BACKOFF_CAP = 8.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+# Timeout of a single Sheets request, and the deadline for a whole call including
+# limiter waits, retries and backoff. The deadline plus one last request stays
+# well under gunicorn's default 30s worker timeout, so a hung Sheets call ends in
+# the fallback instead of the worker being killed (and its breaker state with it).
+SHEETS_REQUEST_TIMEOUT = float(os.getenv('SHEETS_REQUEST_TIMEOUT', 5))
+SHEETS_CALL_DEADLINE = float(os.getenv('SHEETS_CALL_DEADLINE', 15))
+
+# Connection errors raised before a request reaches Sheets, safe to retry for any call
+CONNECT_ERRORS = (ConnectionRefusedError, socket.gaierror, httplib2.ServerNotFoundError)
+
+class SheetsUnavailable(Exception):
+    pass
+
+# Token bucket refilled continuously at `per_minute` tokens per minute
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token, sleeping until it is available. The token is reserved
+    # under the lock, so concurrent callers queue up instead of racing.
+    # Returns the seconds waited, or None without taking a token if the wait
+    # would be longer than max_wait.
+    def acquire(self, max_wait=None):
+        with self.lock:
+            self.refill()
+            if max_wait is not None and (1 - self.tokens) / self.rate > max_wait:
+                return None
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return max(self.tokens, 0)
+
+# Opens after consecutive failures, then lets a single trial call through
+# once the reset timeout has passed
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+# Wrapper around the Sheets values API: rate limits reads and writes against
+# this worker's share of the quota, retries 429/5xx with exponential backoff and jitter, and keeps the
+# last full-sheet read to serve while the circuit breaker is open
+class SheetsClient:
+    def __init__(self, spreadsheets):
+        self.spreadsheets = spreadsheets
+        self.limiters = {
+            'read': TokenBucket(SHEETS_READS_PER_MINUTE_PER_WORKER),
+            'write': TokenBucket(SHEETS_WRITES_PER_MINUTE_PER_WORKER),
+        }
+        # Reads and writes have separate quotas, so throttling on one must not block the other
+        self.breakers = {kind: CircuitBreaker() for kind in self.limiters}
+        self.stats = {kind: defaultdict(int) for kind in self.limiters}
+        self.stats_lock = threading.Lock()
+        self.last_good_values = None
+        self.local = threading.local()
+
+    def count(self, kind, name, amount=1):
+        with self.stats_lock:
+            self.stats[kind][name] += amount
+
+    # httplib2 is not thread-safe, so each request thread gets its own connection
+    def http(self):
+        if not hasattr(self.local, 'http'):
+            self.local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_REQUEST_TIMEOUT))
+        return self.local.http
+
+    # idempotent=False is for calls that must not run twice, like append: they
+    # are only retried on 429 or when the request never reached Sheets, since a
+    # 5xx or timeout may come after the write was committed
+    def execute(self, kind, request, idempotent=True):
+        breaker = self.breakers[kind]
+        if not breaker.allow():
+            self.count(kind, 'short_circuited')
+            raise SheetsUnavailable('Google Sheets circuit breaker is open')
+
+        # Every way out of this call reports to the breaker, so a half-open
+        # breaker always moves back to closed or open
+        service_answered = False
+        deadline = time.monotonic() + SHEETS_CALL_DEADLINE
+        try:
+            for attempt in range(SHEETS_MAX_RETRIES + 1):
+                wait = self.limiters[kind].acquire(max_wait=deadline - time.monotonic())
+                if wait is None:
+                    # Out of time waiting for quota; a retry re-raises the error it was retrying
+                    self.count(kind, 'deadline_exceeded')
+                    if attempt == 0:
+                        error = SheetsUnavailable('Google Sheets quota wait would pass the call deadline')
+                    break
+                self.count(kind, 'limiter_wait_seconds', wait)
+                self.count(kind, 'calls')
+                try:
+                    result = request.execute(http=self.http())
+                    service_answered = True
+                    return result
+                except HttpError as e:
+                    status = e.resp.status
+                    if status == 429:
+                        self.count(kind, 'throttled')
+                    # Other client errors won't succeed on retry, but Sheets did answer
+                    if status != 429 and status < 500:
+                        service_answered = True
+                        self.count(kind, 'failed')
+                        raise
+                    if status != 429 and not idempotent:
+                        self.count(kind, 'failed')
+                        raise
+                    error = e
+                except (OSError, httplib2.HttpLib2Error) as e:
+                    if not idempotent and not isinstance(e, CONNECT_ERRORS):
+                        self.count(kind, 'failed')
+                        raise
+                    error = e
+
+                if attempt < SHEETS_MAX_RETRIES:
+                    # Exponential backoff with full jitter, unless it would pass the deadline
+                    delay = random.uniform(0, min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                    if time.monotonic() + delay >= deadline:
+                        self.count(kind, 'deadline_exceeded')
+                        break
+                    self.count(kind, 'retries')
+                    time.sleep(delay)
+
+            self.count(kind, 'failed')
+            raise error
+        finally:
+            if service_answered:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    def get(self, range_name):
+        return self.execute('read', self.spreadsheets.values().get(spreadsheetId=SPREADSHEET_ID, range=range_name))
+
+    # Function to read the whole sheet, falling back to the last good read if Sheets
+    # is failing. Returns the snapshot and whether it is such a stale fallback.
+    # The snapshot is shared and must not be modified; a stale fallback returns
+    # the same object as the read it falls back to.
+    def get_snapshot(self):
+        try:
+            values = self.get(RANGE_NAME).get('values', [])
+            self.last_good_values = values
+            return values, False
+        except Exception as e:
+            if self.last_good_values is None:
+                raise
+            print(f"Error fetching data, serving last good snapshot: {e}")
+            self.count('read', 'stale_reads')
+            return self.last_good_values, True
+
+    def append(self, data):
+        return self.execute('write', self.spreadsheets.values().append(
+            spreadsheetId=SPREADSHEET_ID,
+            range=RANGE_NAME,  # Append to the entire sheet
+            valueInputOption="RAW",  # RAW or USER_ENTERED based on your preference
+            insertDataOption="INSERT_ROWS",  # Insert new rows at the end
+            body={'values': [data]}
+        ), idempotent=False)
+
+    def update(self, range_name, data):
+        return self.execute('write', self.spreadsheets.values().update(
+            spreadsheetId=SPREADSHEET_ID,
+            range=range_name,
+            valueInputOption='RAW',
+            body={'values': [data]}
+        ))
+
+    def clear(self, range_name):
+        return self.execute('write', self.spreadsheets.values().clear(
+            spreadsheetId=SPREADSHEET_ID,
+            range=range_name,
+        ))
+
+    # Request counters and remaining quota, for the /sheets_stats endpoint
+    def quota_stats(self):
+        with self.stats_lock:
+            stats = {kind: dict(counters) for kind, counters in self.stats.items()}
+        for kind, limiter in self.limiters.items():
+            stats[kind]['per_minute_this_worker'] = limiter.capacity
+            stats[kind]['tokens_available'] = round(limiter.available(), 2)
+            stats[kind]['breaker'] = self.breakers[kind].state
+        stats['workers'] = SHEETS_WORKERS
+        stats['has_last_good_snapshot'] = self.last_good_values is not None
+        return stats
+
+sheets_client = SheetsClient(sheet)
+
+# Seconds the row index is trusted without a full read, to pick up edits made
+# directly in the Google Sheet
+ROW_INDEX_TTL = int(os.getenv('ROW_INDEX_TTL', 300))
+
+# Function to format a cell the way Sheets returns it, so checksums of rows we
+# wrote match checksums of the same rows read back
+def format_cell(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+# Row-addressable index over the latest full-sheet snapshot. rows[i] and
+# checksums[i] hold sheet row i + 1, so an edit is served without fetching the
+# row, and the checksum acts as the row's version for optimistic concurrency.
+class RowIndex:
+    def __init__(self):
+        self.rows = None
+        self.snapshot = None
+        self.checksums = array('I')
+        self.version = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    # Sheets leaves trailing empty cells out of the rows it returns, so they are
+    # dropped here too, or a row we wrote with a blank last cell would checksum
+    # differently from the same row read back
+    @staticmethod
+    def trim(row):
+        cells = [format_cell(cell) for cell in row]
+        while cells and cells[-1] == '':
+            cells.pop()
+        return cells
+
+    @classmethod
+    def checksum(cls, row):
+        return zlib.crc32('\x1f'.join(cls.trim(row)).encode())
+
+    # Load from a shared snapshot. The index keeps its own copy of the rows,
+    # since set() edits them in place.
+    def load(self, snapshot, version):
+        with self.lock:
+            # A stale fallback hands back the snapshot that is already loaded
+            if snapshot is self.snapshot:
+                return
+            self.snapshot = snapshot
+            self.rows = [list(row) for row in snapshot]
+            self.checksums = array('I', (self.checksum(row) for row in self.rows))
+            self.version = version
+            self.loaded_at = time.monotonic()
+
+    # True if the snapshot is recent and no worker has written since it was taken
+    def is_current(self):
+        return (self.rows is not None and self.version == get_data_version()
+                and time.monotonic() - self.loaded_at < ROW_INDEX_TTL)
+
+    # Returns the row and its checksum, or (None, None) for a blank or unknown row
+    def get(self, row_number):
+        with self.lock:
+            index = row_number - 1
+            if self.rows is None or not 0 <= index < len(self.rows) or not self.rows[index]:
+                return None, None
+            return list(self.rows[index]), self.checksums[index]
+
+    def set(self, row_number, row):
+        with self.lock:
+            if self.rows is None:
+                return
+            index = row_number - 1
+            while len(self.rows) <= index:
+                self.rows.append([])
+                self.checksums.append(self.checksum([]))
+            self.rows[index] = self.trim(row)
+            self.checksums[index] = self.checksum(self.rows[index])
+
+    def row_count(self):
+        with self.lock:
+            return len(self.rows) if self.rows is not None else 0
+
+row_index = RowIndex()
+
+# Function to flag the current request as rendered from fallback data (empty or
+# stale), so cached_page doesn't keep the page once Sheets recovers
+def mark_sheets_fallback():
+    if has_app_context():
+        g.sheets_fallback = True
+
 # Function to get data from Google Sheets (fetch all data)
 def get_data_from_google_sheets():
+    # Read the version first, so the index never claims to be newer than its data
+    version = get_data_version()
     try:
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-        values = result.get('values', [])
-        return values
+        snapshot, stale = sheets_client.get_snapshot()
     except Exception as e:
         print(f"Error fetching data: {e}")
+        mark_sheets_fallback()
         return []
+    if stale:
+        mark_sheets_fallback()
+    row_index.load(snapshot, version)
+    # Callers may modify the rows, so the snapshot is never handed out directly
+    return [list(row) for row in snapshot]
 
-def get_row_count_from_google_sheets():
-    try:
-        # Refresh the service to ensure it is aware of new values
-        global service, sheet
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
-        
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-        values = result.get('values', [])
-        row_count = len(values)  # Get the number of rows
-        return row_count
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        return 0  # Return 0 if an error occurs
-
+# Function to make sure the row index is usable, with a full read only when it is stale
+def refresh_row_index():
+    if not row_index.is_current():
+        get_data_from_google_sheets()
 
-# Function to append data to Google Sheets
+def get_row_count_from_google_sheets():
+    refresh_row_index()
+    return row_index.row_count()  # Get the number of rows, 0 if an error occurs
+
+# Function to apply a write made by this worker to the row index and bump the
+# data version. Returns the new data version.
+def record_write(row_number, row):
+    was_current = row_index.is_current()
+    if row_number is not None:
+        row_index.set(row_number, row)
+    version = bump_data_version()
+    # The index already holds our own write, so it stays current, unless another
+    # worker also wrote since the index was checked
+    if was_current and row_number is not None and version == row_index.version + 1:
+        row_index.version = version
+    return version
+
+
+# Function to append data to Google Sheets. Returns False if the append failed.
 def append_into_sheet(data):
+    global sketches_version
+    version_before = get_data_version()
+    sent_at = time.monotonic()
+
+    # Append the data into the sheet
     try:
-        # Prepare the data in the format required by Google Sheets
-        body = {'values': [data]}
-        
-        # Append the data into the sheet
-        result = sheet.values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range='sheet1',  # Append to the entire sheet
-            valueInputOption="RAW",  # RAW or USER_ENTERED based on your preference
-            insertDataOption="INSERT_ROWS",  # Insert new rows at the end
-            body=body
-        ).execute()
-        print(f"Appended {len(data)} rows.")
+        result = sheets_client.append(data)
     except Exception as e:
         print(f"Error appending data: {e}")
+        return False
+    print(f"Appended {len(data)} rows.")
+
+    # The response says which row the data landed in
+    updated_range = result.get('updates', {}).get('updatedRange', '')
+    match = re.search(r'!A(\d+)', updated_range)
+    version_after = record_write(int(match.group(1)) if match else None, data)
+
+    # Fold the new row into the distribution sketches instead of rebuilding
+    # them, but only if they were fetched before the row was sent and no
+    # other write happened while it was in flight. Sketches fetched later
+    # may already hold the row and would count it twice, and a write from
+    # another worker would be missing from them.
+    with sketch_lock:
+        if (distribution_sketches is not None and sketches_version == version_before
+                and version_after == version_before + 1 and sketches_fetched_at < sent_at):
+            add_row_to_sketches(distribution_sketches, data)
+            sketches_version = version_after
+    return True
+
+# Function to fetch a row and its checksum from the row index
+def fetch_row_with_version(row_number):
+    try:
+        row_number = int(row_number)
+    except (TypeError, ValueError):
+        return None, None
+    refresh_row_index()
+    return row_index.get(row_number)
 
 # Function to fetch a row from Google Sheets
 def fetch_row_data(row_number):
-    range_name = f'{RANGE_NAME}!A{row_number}:K{row_number}'  # Adjust range if necessary
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=range_name).execute()
-    values = result.get('values', [])
-    if values:
-        return values[0]
-    return None
+    return fetch_row_with_version(row_number)[0]
 
-# Function to update a row in Google Sheets
-def update_row_data(row_number, data):
-    range_name = f'{RANGE_NAME}!A{row_number}:K{row_number}'  # Adjust range if necessary
-    body = {
-        'values': [data]
-    }
-    result = sheet.values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=range_name,
-        valueInputOption='RAW',
-        body=body
-    ).execute()
+# Function to update a row in Google Sheets. With expected_version, the write is
+# refused (returning False) if the row changed since that version was read.
+def update_row_data(row_number, data, expected_version=None):
+    if expected_version is not None:
+        _, current_version = fetch_row_with_version(row_number)
+        if current_version != expected_version:
+            return False
+
+    range_name = f'{RANGE_NAME}!A{row_number}:L{row_number}'  # Adjust range if necessary
+    sheets_client.update(range_name, data)
+    record_write(int(row_number), data)
+    invalidate_sketches()
+    return True
 
 
 # Function to delete a row in Google Sheets
 def delete_row_data(row_number):
-    range_name = f'{RANGE_NAME}!A{row_number}:K{row_number}'  # Adjust range if necessary
-    result = sheet.values().clear(
-        spreadsheetId=SPREADSHEET_ID,
-        range=range_name,
-    ).execute()
+    range_name = f'{RANGE_NAME}!A{row_number}:L{row_number}'  # Adjust range if necessary
+    sheets_client.clear(range_name)
+    record_write(int(row_number), [])
+    invalidate_sketches()
 
 # Function to fetch the entire Google Sheet data
 def get_sheet_data():
     # Fetch all data from the specified range (entire sheet)
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-    
-    # Get the rows of data
-    rows = result.get('values', [])
-    
-    return rows
+    return get_data_from_google_sheets()
 
+# The data version is a counter kept in a shared file, so a write in one
+# gunicorn worker invalidates the rendered pages cached by every other worker
+# too. Each write adds exactly one, so a worker can tell whether its write was
+# the only one since it last read the version.
+DATA_VERSION_FILE = os.getenv('DATA_VERSION_FILE', os.path.join(tempfile.gettempdir(), 'healthcare_dashboard_data_version'))
 
+# Seconds a rendered page is served before re-rendering, to pick up edits made
+# directly in the Google Sheet
+RENDER_CACHE_TTL = int(os.getenv('RENDER_CACHE_TTL', 60))
+RENDER_CACHE_SIZE = 256
+
+render_cache = {}
+render_cache_lock = threading.Lock()
+
+def read_version_counter(f):
+    try:
+        return int(f.read() or 0)
+    except ValueError:
+        return 0
+
+def get_data_version():
+    try:
+        with open(DATA_VERSION_FILE) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return read_version_counter(f)
+    except OSError:
+        return 0
+
+# Function to mark the data as changed, called by every write path. Returns the new version.
+def bump_data_version():
+    with open(os.open(DATA_VERSION_FILE, os.O_RDWR | os.O_CREAT, 0o644), 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        version = read_version_counter(f) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(version))
+    with render_cache_lock:
+        render_cache.clear()
+    return version
+
+# Function to compress a rendered page once, for every encoding we can serve
+def compress_page(body):
+    encoded = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(body)
+    return encoded
+
+# Decorator caching a read-only page by route, query arguments and data version.
+# Only the query arguments named in query_args are part of the key, each mapped
+# to the values the view accepts; anything else the view ignores, so it must
+# not create cache entries (and full-sheet reads) of its own.
+def cached_page(**query_args):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.path,) + tuple(
+                request.args.get(name) if request.args.get(name) in allowed else None
+                for name, allowed in sorted(query_args.items())
+            )
+            version = get_data_version()
+            now = time.monotonic()
+
+            with render_cache_lock:
+                entry = render_cache.get(key)
+            if entry is None or entry['version'] != version or now - entry['rendered_at'] > RENDER_CACHE_TTL:
+                response = make_response(view(*args, **kwargs))
+                # Only successful pages rendered from a fresh read are cached
+                if response.status_code != 200 or g.get('sheets_fallback'):
+                    return response
+                entry = {
+                    'version': version,
+                    'rendered_at': now,
+                    'mimetype': response.mimetype,
+                    'etag': f'{version}-{hashlib.md5(response.get_data()).hexdigest()}',
+                    'bodies': compress_page(response.get_data()),
+                }
+                with render_cache_lock:
+                    if key not in render_cache and len(render_cache) >= RENDER_CACHE_SIZE:
+                        render_cache.pop(next(iter(render_cache)))
+                    render_cache[key] = entry
+
+            # Pick the best precompressed body the client accepts
+            encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in entry['bodies']], default='identity')
+            response = make_response(entry['bodies'][encoding])
+            response.mimetype = entry['mimetype']
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+            response.headers['Vary'] = 'Accept-Encoding'
+            response.set_etag(f"{entry['etag']}-{encoding}")
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
 
 
 class DiabetesForm(FlaskForm):
@@ -147,6 +629,10 @@ class DiabetesForm(FlaskForm):
     outcome = SelectField('Outcome', choices=[(0, 'Negative'), (1, 'Positive')], validators=[DataRequired()])
     submit = SubmitField('Submit')
 
+class EditRowForm(DiabetesForm):
+    # Checksum of the row when the form was loaded
+    row_version = HiddenField('Row Version')
+
 class PredictionForm(FlaskForm):
     pregnancies = IntegerField('Pregnancies', validators=[InputRequired(), NumberRange(min=0, max=18)])
     glucose = IntegerField('Glucose', validators=[InputRequired(), NumberRange(min=0, max=200)])
@@ -159,6 +645,11 @@ class PredictionForm(FlaskForm):
     submit = SubmitField('Predict')
 
 
+class RetrainForm(FlaskForm):
+    mode = SelectField('Mode', choices=[('incremental', 'Incremental update'), ('full', 'Full refit')], validators=[DataRequired()])
+    submit = SubmitField('Retrain')
+
+
 class UpdateForm(FlaskForm):
     row_number = IntegerField('Row Number', validators=[InputRequired()])
     submit = SubmitField('Update')
@@ -177,255 +668,374 @@ class DeleteForm(FlaskForm):
         if max_rows is not None:
             self.row_number.validators.append(NumberRange(min=0, max=max_rows))
 
-def process_data(values):
-    # Initialize a dictionary to count diabetes outcomes by age group
-    age_group_count = defaultdict(int)
+# Numeric columns: sheet index and the value range allowed by DiabetesForm
+NUMERIC_COLUMNS = {
+    'Pregnancies': (0, 0, 18),
+    'Glucose': (1, 0, 200),
+    'BloodPressure': (2, 0, 200),
+    'SkinThickness': (3, 0, 100),
+    'Insulin': (4, 0, 1000),
+    'BMI': (5, 0.0, 100.0),
+    'DiabetesPedigreeFunction': (6, 0.0, 3.0),
+    'Age': (7, 20, 120),
+}
+
+# Columns where '0' means the value was not recorded
+ZERO_MEANS_MISSING = {'Glucose', 'BloodPressure', 'SkinThickness', 'Insulin', 'BMI', 'DiabetesPedigreeFunction'}
+
+# Categorical columns the distributions are grouped by
+GROUP_COLUMNS = {'AgeGroup': 9, 'BMIClass': 10}
+
+# Width of a complete row, Pregnancies..BMIClass
+ROW_WIDTH = 11
+OUTCOME_INDEX = 8
+
+# Function returning which values of a numeric column are usable: present,
+# within the DiabetesForm bounds and not a '0' standing in for a missing value.
+# Works on a single value or an array of them.
+def valid_numeric(column, x):
+    _, low, high = NUMERIC_COLUMNS[column]
+    valid = ~np.isnan(x) & (x >= low) & (x <= high)
+    if column in ZERO_MEANS_MISSING:
+        valid &= x != 0
+    return valid
+
+# Vectorized AgeGroup, matching compute_age_group
+def derive_age_groups(age):
+    conditions = [(age >= low) & (age < low + 10) for low in range(20, 70, 10)]
+    return np.select(conditions, [f'{low}-{low + 10}' for low in range(20, 70, 10)], default='Others')
+
+# Vectorized BMIClass, matching compute_bmi_class
+def derive_bmi_classes(bmi):
+    conditions = [bmi < 18.5, (18.5 <= bmi) & (bmi < 24.9), (25 <= bmi) & (bmi < 29.9)]
+    return np.select(conditions, ['Underweight', 'Healthy', 'Overweight'], default='Obese')
+
+# Data-quality pass over one snapshot of the sheet. The masks built here are the
+# single set of validity rules every aggregation below uses.
+class DataQuality:
+    def __init__(self, values):
+        rows = values[1:]
+        matrix = retrain.numeric_matrix(values, width=OUTCOME_INDEX + 1)
+        lengths = np.array([len(row) for row in rows], dtype=int)
+
+        # Sheet row number of each data row (row 1 is the header)
+        self.row_numbers = np.arange(2, len(rows) + 2)
+        self.blank = lengths == 0
+        self.short = (lengths > 0) & (lengths < ROW_WIDTH)
+
+        self.columns = {column: matrix[:, index] for column, (index, _, _) in NUMERIC_COLUMNS.items()}
+        self.missing = {column: np.isnan(x) & ~self.blank for column, x in self.columns.items()}
+        self.zero = {column: x == 0 for column, x in self.columns.items()}
+        self.out_of_range = {}
+        for column, (_, low, high) in NUMERIC_COLUMNS.items():
+            x = self.columns[column]
+            self.out_of_range[column] = ~np.isnan(x) & ((x < low) | (x > high))
+        self.valid = {column: valid_numeric(column, x) for column, x in self.columns.items()}
+
+        self.outcome = matrix[:, OUTCOME_INDEX]
+        self.valid_outcome = np.isin(self.outcome, (0, 1))
+        self.invalid_outcome = ~self.valid_outcome & ~self.blank
+
+        self.groups = {
+            group: np.array([row[index] if len(row) > index else '' for row in rows], dtype=str)
+            for group, index in GROUP_COLUMNS.items()
+        }
+        self.has_group = {group: labels != '' for group, labels in self.groups.items()}
+
+        # Stored AgeGroup/BMIClass that disagree with the Age/BMI in the same row
+        with np.errstate(invalid='ignore'):
+            derived = {
+                'AgeGroup': derive_age_groups(self.columns['Age']),
+                'BMIClass': derive_bmi_classes(self.columns['BMI']),
+            }
+        self.inconsistent = {
+            'AgeGroup': self.has_group['AgeGroup'] & ~np.isnan(self.columns['Age']) & (self.groups['AgeGroup'] != derived['AgeGroup']),
+            'BMIClass': self.has_group['BMIClass'] & ~np.isnan(self.columns['BMI']) & (self.groups['BMIClass'] != derived['BMIClass']),
+        }
+
+    # Per-column counts for the /quality page
+    def column_report(self):
+        return [
+            {
+                'column': column,
+                'missing': int(self.missing[column].sum()),
+                'zero': int(self.zero[column].sum()),
+                'zero_means_missing': column in ZERO_MEANS_MISSING,
+                'out_of_range': int(self.out_of_range[column].sum()),
+                'valid': int(self.valid[column].sum()),
+                'low': NUMERIC_COLUMNS[column][1],
+                'high': NUMERIC_COLUMNS[column][2],
+            }
+            for column in NUMERIC_COLUMNS
+        ]
 
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        outcome = row[8]     # Index for 'Outcome'
-        
-        if outcome == '1':  # Assuming Outcome is stored as '1' or '0'
-            age_group_count[age_group] += 1
+    def rows_where(self, mask, limit=50):
+        return self.row_numbers[mask][:limit].tolist()
+
+# The quality pass of the most recent snapshot, so all the aggregations for one
+# page share a single pass
+data_quality_cache = (None, None)
+
+def get_data_quality(values):
+    global data_quality_cache
+    cached_values, quality = data_quality_cache
+    if cached_values is not values:
+        quality = DataQuality(values)
+        data_quality_cache = (values, quality)
+    return quality
+
+# Function to group the rows selected by mask, keeping groups in order of first
+# appearance. Returns the group labels and each selected row's group position.
+def first_seen_groups(labels, mask):
+    unique, first, inverse = np.unique(labels[mask], return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    return unique[order].tolist(), position[inverse.reshape(-1)]
+
+# Function to average a numeric column per age group over its valid values
+def average_by_age_group(values, column):
+    quality = get_data_quality(values)
+    mask = quality.valid[column] & quality.has_group['AgeGroup']
+    age_groups, position = first_seen_groups(quality.groups['AgeGroup'], mask)
+    sums = np.bincount(position, weights=quality.columns[column][mask], minlength=len(age_groups))
+    counts = np.bincount(position, minlength=len(age_groups))
+    return age_groups, [round(float(total / count), 2) for total, count in zip(sums, counts)]
+
+# Function to average a numeric column over its valid values
+def overall_average(values, column):
+    quality = get_data_quality(values)
+    valid_values = quality.columns[column][quality.valid[column]]
+    return round(float(valid_values.mean()), 2) if len(valid_values) > 0 else 0
 
-    # Prepare the AgeGroup and Count of Outcome data for Chart.js
-    age_groups = list(age_group_count.keys())
-    diabetes_counts = list(age_group_count.values())
+def process_data(values):
+    # Count diabetes outcomes by age group
+    quality = get_data_quality(values)
+    mask = quality.valid_outcome & (quality.outcome == 1) & quality.has_group['AgeGroup']
+    age_groups, position = first_seen_groups(quality.groups['AgeGroup'], mask)
+    diabetes_counts = np.bincount(position, minlength=len(age_groups)).tolist()
 
     return age_groups, diabetes_counts
 
 def process_data2(values):
-    # Initialize a dictionary to count diabetes outcomes and total by age group
-    age_group_count = defaultdict(int)
-    age_group_total = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        outcome = row[8]     # Index for 'Outcome'
-        
-        age_group_total[age_group] += 1  # Count total people in each age group
-        
-        if outcome == '1':  # Count diabetic people (Outcome = 1)
-            age_group_count[age_group] += 1
-
-    # Prepare AgeGroup, Count of Diabetes, and Total for calculating prevalence
-    age_groups = list(age_group_total.keys())
-    diabetes_prevalence = [round((age_group_count[age] / age_group_total[age]) * 100, 2) for age in age_groups]
+    # Count diabetes outcomes and total by age group, for calculating prevalence
+    quality = get_data_quality(values)
+    mask = quality.valid_outcome & quality.has_group['AgeGroup']
+    age_groups, position = first_seen_groups(quality.groups['AgeGroup'], mask)
+    totals = np.bincount(position, minlength=len(age_groups))
+    diabetic = np.bincount(position, weights=quality.outcome[mask], minlength=len(age_groups))
+    diabetes_prevalence = [round(float(d / t) * 100, 2) for d, t in zip(diabetic, totals)]
 
     return age_groups, diabetes_prevalence
 
 def process_insulin_data(values):
-    # Initialize dictionaries to sum insulin and count the number of people in each age group
-    age_group_insulin_sum = defaultdict(float)
-    age_group_count = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        insulin = row[4]     # Index for 'Insulin'
-        
-        # Skip rows where Insulin is not provided (assuming it's empty or '0')
-        if insulin and insulin != '0':
-            age_group_insulin_sum[age_group] += float(insulin)
-            age_group_count[age_group] += 1
-
-    # Calculate average insulin for each age group
-    age_groups = list(age_group_insulin_sum.keys())
-    average_insulin = [round(age_group_insulin_sum[age] / age_group_count[age], 2) for age in age_groups]
-
-    return age_groups, average_insulin
+    return average_by_age_group(values, 'Insulin')
 
 def process_blood_pressure_data(values):
-    # Initialize dictionaries to sum blood pressure and count the number of people in each age group
-    age_group_bp_sum = defaultdict(float)
-    age_group_count = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        blood_pressure = row[2]  # Index for 'BloodPressure'
-        
-        # Skip rows where Blood Pressure is not provided (assuming it's empty or '0')
-        if blood_pressure and blood_pressure != '0':
-            age_group_bp_sum[age_group] += float(blood_pressure)
-            age_group_count[age_group] += 1
-
-    # Calculate average blood pressure for each age group
-    age_groups = list(age_group_bp_sum.keys())
-    average_blood_pressure = [round(age_group_bp_sum[age] / age_group_count[age], 2) for age in age_groups]
-
-    return age_groups, average_blood_pressure
+    return average_by_age_group(values, 'BloodPressure')
 
 def process_skin_thickness_data(values):
-    # Initialize dictionaries to sum skin thickness and count the number of people in each age group
-    age_group_skin_sum = defaultdict(float)
-    age_group_count = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        skin_thickness = row[3]  # Index for 'SkinThickness'
-        
-        # Skip rows where Skin Thickness is not provided (assuming it's empty or '0')
-        if skin_thickness and skin_thickness != '0':
-            age_group_skin_sum[age_group] += float(skin_thickness)
-            age_group_count[age_group] += 1
-
-    # Calculate average skin thickness for each age group
-    age_groups = list(age_group_skin_sum.keys())
-    average_skin_thickness = [round(age_group_skin_sum[age] / age_group_count[age], 2) for age in age_groups]
-
-    return age_groups, average_skin_thickness
+    return average_by_age_group(values, 'SkinThickness')
 
 def process_glucose_data(values):
-    # Initialize dictionaries to sum glucose and count the number of people in each age group
-    age_group_glucose_sum = defaultdict(float)
-    age_group_count = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        glucose = row[1]  # Index for 'Glucose'
-        
-        # Skip rows where Glucose is not provided (assuming it's empty or '0')
-        if glucose and glucose != '0':
-            age_group_glucose_sum[age_group] += float(glucose)
-            age_group_count[age_group] += 1
-
-    # Calculate average glucose for each age group
-    age_groups = list(age_group_glucose_sum.keys())
-    average_glucose = [round(age_group_glucose_sum[age] / age_group_count[age], 2) for age in age_groups]
-
-    return age_groups, average_glucose
+    return average_by_age_group(values, 'Glucose')
 
 def process_pedigree_function_data(values):
-    # Initialize dictionaries to sum diabetes pedigree function and count the number of people in each age group
-    age_group_pedigree_sum = defaultdict(float)
-    age_group_count = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        age_group = row[9]  # Index for 'AgeGroup'
-        diabetes_pedigree_function = row[6]  # Index for 'DiabetesPedigreeFunction'
-        
-        # Skip rows where Diabetes Pedigree Function is not provided (assuming it's empty or '0')
-        if diabetes_pedigree_function and diabetes_pedigree_function != '0':
-            age_group_pedigree_sum[age_group] += float(diabetes_pedigree_function)
-            age_group_count[age_group] += 1
-
-    # Calculate average Diabetes Pedigree Function for each age group
-    age_groups = list(age_group_pedigree_sum.keys())
-    average_pedigree_function = [round(age_group_pedigree_sum[age] / age_group_count[age], 2) for age in age_groups]
-
-    return age_groups, average_pedigree_function
+    return average_by_age_group(values, 'DiabetesPedigreeFunction')
 
 def process_avgbmi_data(values):
-    # Initialize variables to sum BMI and count the number of entries
-    total_bmi = 0.0
-    count = 0
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        bmi = row[5]  # Index for 'BMI'
-        
-        # Skip rows where BMI is not provided (assuming it's empty or '0')
-        if bmi and bmi != '0':
-            total_bmi += float(bmi)
-            count += 1
-
-    # Calculate average BMI
-    average_bmi = round(total_bmi / count, 2) if count > 0 else 0
-
-    return average_bmi
+    return overall_average(values, 'BMI')
 
 def process_avgglucose_data(values):
-    # Initialize variables to sum BMI and count the number of entries
-    total_glucose = 0.0
-    count = 0
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        glucose = row[1]  # Index for 'BMI'
-        
-        # Skip rows where BMI is not provided (assuming it's empty or '0')
-        if glucose and glucose != '0':
-            total_glucose += float(glucose)
-            count += 1
-
-    # Calculate average BMI
-    average_glucose = round(total_glucose / count, 2) if count > 0 else 0
-
-    return average_glucose
+    return overall_average(values, 'Glucose')
 
 def process_avgbp_data(values):
-    # Initialize variables to sum BMI and count the number of entries
-    total_bp = 0.0
-    count = 0
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        bp = row[2]  # Index for 'BMI'
-        
-        # Skip rows where BMI is not provided (assuming it's empty or '0')
-        if bp and bp != '0':
-            total_bp += float(bp)
-            count += 1
-
-    # Calculate average BMI
-    average_bp = round(total_bp / count, 2) if count > 0 else 0
-
-    return average_bp
+    return overall_average(values, 'BloodPressure')
 
 def process_count(values):
-    count = 0
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        bp = row[7]  # Index for 'Pregnancies'
-        
-        if bp:
-            count += 1
-
-    return count
+    # Count the patients, i.e. the rows with an Age
+    quality = get_data_quality(values)
+    return int((~np.isnan(quality.columns['Age'])).sum())
 
 def process_pie_chart_data(values):
-    # Initialize a dictionary to count pregnancies where pregnancies > 0 for each outcome
-    outcome_counts = defaultdict(int)
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        pregnancies = row[0]  # Index for 'Pregnancies'
-        outcome = row[8]      # Index for 'Outcome'
-        
-        if pregnancies and int(pregnancies) > 0:
-            outcome_counts[outcome] += 1
-
-    # Return the count for each outcome
-    outcomes = list(outcome_counts.keys())
-    pregnancies_counts = [outcome_counts[outcome] for outcome in outcomes]
+    # Count rows with pregnancies > 0 for each outcome
+    quality = get_data_quality(values)
+    mask = quality.valid['Pregnancies'] & (quality.columns['Pregnancies'] > 0) & quality.valid_outcome
+    outcome_labels = np.where(quality.valid_outcome, quality.outcome, 0).astype(int).astype(str)
+    outcomes, position = first_seen_groups(outcome_labels, mask)
+    pregnancies_counts = np.bincount(position, minlength=len(outcomes)).tolist()
 
     return outcomes, pregnancies_counts
 
 def process_stacked_bar_chart_data(values):
-    # Initialize a dictionary to count the number of outcomes for each BMIClass
-    bmi_class_counts = defaultdict(lambda: {'0': 0, '1': 0})
-
-    # Process rows, assuming the first row is the header
-    for row in values[1:]:
-        bmi_class = row[10]  # Index for 'BMIClass'
-        outcome = row[8]     # Index for 'Outcome'
-
-        if bmi_class and outcome:
-            bmi_class_counts[bmi_class][outcome] += 1
-
-    # Convert the dictionary to lists for the chart
-    bmi_classes = list(bmi_class_counts.keys())
-    outcome_0_counts = [bmi_class_counts[bmi]['0'] for bmi in bmi_classes]
-    outcome_1_counts = [bmi_class_counts[bmi]['1'] for bmi in bmi_classes]
+    # Count the number of outcomes for each BMIClass
+    quality = get_data_quality(values)
+    mask = quality.valid_outcome & quality.has_group['BMIClass']
+    bmi_classes, position = first_seen_groups(quality.groups['BMIClass'], mask)
+    diabetic = quality.outcome[mask] == 1
+    outcome_0_counts = np.bincount(position[~diabetic], minlength=len(bmi_classes)).tolist()
+    outcome_1_counts = np.bincount(position[diabetic], minlength=len(bmi_classes)).tolist()
 
     return bmi_classes, outcome_0_counts, outcome_1_counts
 
+HISTOGRAM_BINS = 20
+
+# Histogram with equal-width bins over a fixed range. Histograms over the same
+# range merge by adding their counts, and percentiles are read from the
+# cumulative counts, so no sort of the raw values is ever needed. An integer
+# range gets bins holding a whole number of integers each, so every bin covers
+# the same number of possible values.
+class FixedBinHistogram:
+    def __init__(self, low, high, bins=HISTOGRAM_BINS):
+        self.low = low
+        self.high = high
+        self.integer = isinstance(low, int) and isinstance(high, int)
+        if self.integer:
+            self.width = -(-(high - low + 1) // bins)
+            bins = -(-(high - low + 1) // self.width)
+        else:
+            self.width = (high - low) / bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def add(self, value):
+        # Out-of-range values are clamped into the edge bins
+        index = int((value - self.low) / self.width)
+        index = min(max(index, 0), len(self.counts) - 1)
+        self.counts[index] += 1
+
+    def add_many(self, values):
+        indexes = np.clip(((values - self.low) / self.width).astype(int), 0, len(self.counts) - 1)
+        self.counts += np.bincount(indexes, minlength=len(self.counts))
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        total = self.total()
+        if total == 0:
+            return None
+
+        # Find the bin holding the q-th percentile and interpolate inside it
+        target = q / 100 * total
+        cumulative = np.cumsum(self.counts)
+        index = min(int(np.searchsorted(cumulative, target)), len(self.counts) - 1)
+        before = cumulative[index] - self.counts[index]
+        fraction = (target - before) / self.counts[index] if self.counts[index] else 0
+        if self.integer:
+            # The integer the fraction falls on, within the bin
+            return int(self.low + index * self.width + min(int(fraction * self.width), self.width - 1))
+        return round(float(self.low + (index + fraction) * self.width), 2)
+
+    def bin_labels(self):
+        if self.integer:
+            starts = [self.low + i * self.width for i in range(len(self.counts))]
+            return [str(start) if self.width == 1 else f'{start}-{min(start + self.width - 1, self.high)}' for start in starts]
+        return [f'{self.low + i * self.width:g}-{self.low + (i + 1) * self.width:g}' for i in range(len(self.counts))]
+
+# Sketches per group value and numeric column, built from one full fetch and
+# then kept up to date by append_into_sheet. They remember the data version
+# they match and when their fetch finished, like the row index.
+distribution_sketches = None
+sketches_version = None
+sketches_fetched_at = 0
+sketch_lock = threading.Lock()
+
+# True if the sketches are recent and no worker has written since they were built.
+# Must be called with sketch_lock held.
+def sketches_are_current():
+    return (distribution_sketches is not None and sketches_version == get_data_version()
+            and time.monotonic() - sketches_fetched_at < RENDER_CACHE_TTL)
+
+def new_histogram_set():
+    return {column: FixedBinHistogram(low, high) for column, (_, low, high) in NUMERIC_COLUMNS.items()}
+
+# Function to read a numeric cell, returning None when it is missing or invalid
+def parse_numeric_cell(row, column):
+    index = NUMERIC_COLUMNS[column][0]
+    if index >= len(row) or row[index] in ('', None):
+        return None
+    try:
+        value = float(row[index])
+    except (TypeError, ValueError):
+        return None
+    return value if valid_numeric(column, np.float64(value)) else None
+
+def add_row_to_sketches(sketches, row):
+    for group, group_index in GROUP_COLUMNS.items():
+        if group_index >= len(row) or not row[group_index]:
+            continue
+        histograms = sketches[group][str(row[group_index])]
+        for column in NUMERIC_COLUMNS:
+            value = parse_numeric_cell(row, column)
+            if value is not None:
+                histograms[column].add(value)
+
+def build_sketches(values):
+    sketches = {group: defaultdict(new_histogram_set) for group in GROUP_COLUMNS}
+    quality = get_data_quality(values)
+    for group in GROUP_COLUMNS:
+        labels = quality.groups[group]
+        for label in np.unique(labels[quality.has_group[group]]).tolist():
+            in_group = labels == label
+            for column in NUMERIC_COLUMNS:
+                sketches[group][label][column].add_many(quality.columns[column][in_group & quality.valid[column]])
+    return sketches
+
+# The fetch and build run outside sketch_lock, since a Sheets read can wait on
+# the limiter and retries while appends in this worker need the lock
+def get_distribution_sketches():
+    global distribution_sketches, sketches_version, sketches_fetched_at
+    with sketch_lock:
+        if sketches_are_current():
+            return distribution_sketches
+
+    # Read the version first, so the sketches never claim to be newer than their data
+    version = get_data_version()
+    values = get_data_from_google_sheets()
+    # Don't keep sketches built from a failed fetch
+    if not values:
+        return build_sketches([])
+    sketches = build_sketches(values)
+
+    with sketch_lock:
+        distribution_sketches = sketches
+        sketches_version = version
+        sketches_fetched_at = time.monotonic()
+    return sketches
+
+# Function to drop the sketches after an edit or delete made by this worker,
+# they are rebuilt on the next read
+def invalidate_sketches():
+    global distribution_sketches
+    with sketch_lock:
+        distribution_sketches = None
+
+def process_distribution_data(column, group_by):
+    sketches = get_distribution_sketches()
+
+    with sketch_lock:
+        groups = sorted(sketches[group_by].keys())
+        histograms = [sketches[group_by][group][column] for group in groups]
+
+        # The overall distribution is the merge of the per-group histograms
+        low, high = NUMERIC_COLUMNS[column][1:]
+        overall = FixedBinHistogram(low, high)
+        for histogram in histograms:
+            overall.merge(histogram)
+
+        bin_labels = overall.bin_labels()
+        group_counts = [histogram.counts.tolist() for histogram in histograms]
+        percentiles = {
+            f'p{q}': [histogram.percentile(q) for histogram in histograms] + [overall.percentile(q)]
+            for q in (10, 50, 90)
+        }
+
+    return groups, bin_labels, group_counts, percentiles
+
 # Function to compute AgeGroup
 def compute_age_group(age):
     if 20 <= age < 30:
@@ -484,6 +1094,7 @@ def preprocess_input_forlogisticregression(data):
 
 
 @app.route('/')
+@cached_page()
 def index():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -560,15 +1171,79 @@ def diabetes_form():
             bmi_class    # Computed BMIClass
         ]
         
-        # Insert the data into Google Sheets
-        append_into_sheet(data)
+        # Insert the data into Google Sheets, keeping the form filled in if that fails
+        if not append_into_sheet(data):
+            return render_template('diabetesform.html', form=form,
+                                   save_error='The entry could not be saved to Google Sheets, please try again.')
+        note_labeled_row()
         flash('Data submitted successfully!', 'success')
         return redirect(url_for('base'))
 
     return render_template('diabetesform.html', form=form)
 
+# Path of the trained model, replaced in place by retrain.py
+MODEL_PATH = os.getenv('MODEL_PATH', 'logistic_regression_model.pkl')
+
+# Start an incremental retrain after this many rows were added through /add in this worker
+RETRAIN_EVERY_ROWS = int(os.getenv('RETRAIN_EVERY_ROWS', 50))
+
 # Sample logistic regression model (You would load your trained model)
-model = joblib.load('logistic_regression_model.pkl')
+model = joblib.load(MODEL_PATH)
+model_mtime = os.stat(MODEL_PATH).st_mtime_ns
+model_lock = threading.Lock()
+
+# Function to return the current model, reloading it when a retrain has replaced
+# the file. Each worker picks up the new model on its next prediction, while
+# requests already running keep the model they started with.
+def get_model():
+    global model, model_mtime
+    mtime = os.stat(MODEL_PATH).st_mtime_ns
+    if mtime != model_mtime:
+        with model_lock:
+            if mtime != model_mtime:
+                model, model_mtime = joblib.load(MODEL_PATH), mtime
+    return model
+
+# Retraining runs in a separate process so it never competes with request
+# threads. The pool is created lazily, after gunicorn has forked the worker.
+retrain_executor = None
+retrain_lock = threading.Lock()
+retrain_status = {'running': False, 'last_report': None}
+rows_since_retrain = 0
+
+# Function to start a retrain in the background, returns False if one is already running
+def start_retrain(mode):
+    global retrain_executor
+    with retrain_lock:
+        if retrain_status['running']:
+            return False
+        retrain_status['running'] = True
+        if retrain_executor is None:
+            retrain_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+    def run():
+        try:
+            values = get_data_from_google_sheets()
+            report = retrain_executor.submit(retrain.retrain, values, MODEL_PATH, mode).result()
+        except Exception as e:
+            report = {'mode': mode, 'accepted': False, 'reason': f'Error retraining: {e}'}
+        print(f"Retrain finished: {report}")
+        with retrain_lock:
+            retrain_status['running'] = False
+            retrain_status['last_report'] = report
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+# Function to count a newly labeled row and retrain once enough have come in
+def note_labeled_row():
+    global rows_since_retrain
+    with retrain_lock:
+        rows_since_retrain += 1
+        if rows_since_retrain < RETRAIN_EVERY_ROWS:
+            return
+        rows_since_retrain = 0
+    start_retrain('incremental')
 
 @app.route('/predict', methods=['GET', 'POST'])
 def predict():
@@ -609,7 +1284,7 @@ def predict():
         processed_data = preprocess_input_forlogisticregression(data2)
 
         # Make a prediction using the Logistic Regression model
-        prediction = model.predict(processed_data.reshape(1, -1))[0]  # Get the prediction (0 or 1)
+        prediction = get_model().predict(processed_data.reshape(1, -1))[0]  # Get the prediction (0 or 1)
         print(f"Prediction: {prediction}")
 
         # Convert prediction to native Python int
@@ -618,18 +1293,31 @@ def predict():
         # Update the outcome variable in data1 with the prediction
         data1[8] = prediction  # Store the prediction in the correct index
 
+        # Mark the row as predicted so retraining doesn't take the outcome as a label
+        data1.append(retrain.PREDICTION_SOURCE)
+
         # Append the complete data1 into the dataset
-        try:
-            append_into_sheet(data1)
-        except Exception as e:
-            print(f"Error appending data: {e}")
+        saved = append_into_sheet(data1)
 
         # Send the prediction result to the user
         result = 'Positive' if prediction == 1 else 'Negative'
-        return render_template('prediction_result.html', result=result)
+        return render_template('prediction_result.html', result=result, saved=saved)
 
     return render_template('predictionform.html', form=form)
 
+# Route to retrain the prediction model
+@app.route('/retrain', methods=['GET', 'POST'])
+def retrain_model():
+    form = RetrainForm()
+    if form.validate_on_submit():
+        if start_retrain(form.mode.data):
+            flash('Retraining started', 'success')
+        else:
+            flash('Retraining is already running', 'info')
+        return redirect(url_for('retrain_model'))
+
+    return render_template('retrain.html', form=form, status=retrain_status)
+
 # Route to update a row
 @app.route('/update', methods=['GET', 'POST'])
 def update_row():
@@ -648,13 +1336,14 @@ def update_row():
 # Route to edit the row data
 @app.route('/edit_row/<row_number>', methods=['GET', 'POST'])
 def edit_row(row_number):
-    row_data = fetch_row_data(row_number)
+    # Served from the row index, so no Sheets read on either GET or POST
+    row_data, row_version = fetch_row_with_version(row_number)
     
     if not row_data:
         flash('Invalid row number or no data found', 'danger')
         return redirect(url_for('update_row'))
 
-    form = DiabetesForm()
+    form = EditRowForm()
 
     # Pre-fill form with fetched data
     if request.method == 'GET':
@@ -667,6 +1356,7 @@ def edit_row(row_number):
         form.diabetes_pedigree_function.data = float(row_data[6])
         form.age.data = int(row_data[7])
         form.outcome.data = int(row_data[8])
+        form.row_version.data = row_version
 
     # Update row with modified data
     if form.validate_on_submit():
@@ -686,11 +1376,15 @@ def edit_row(row_number):
             age,
             form.outcome.data,
             age_group,
-            bmi_class
+            bmi_class,
+            ''                # Clear Source, the outcome has now been reviewed
         ]
         
-        # Update the row in Google Sheets
-        update_row_data(row_number, data)
+        # Update the row in Google Sheets, unless it changed since the form was loaded
+        expected_version = int(form.row_version.data) if str(form.row_version.data).isdigit() else None
+        if not update_row_data(row_number, data, expected_version):
+            flash('This row was changed by someone else, please review it and submit again', 'danger')
+            return redirect(url_for('edit_row', row_number=row_number))
         flash('Row updated successfully!', 'success')
         return redirect(url_for('base'))
 
@@ -713,23 +1407,57 @@ def delete_row():
     return render_template('delete_row_number.html', form=form)
 
 @app.route('/view')
+@cached_page()
 def view_sheet():
     # Fetch the Google Sheet data
     sheet_data = get_sheet_data()
 
+    # Label the Source column if the sheet header doesn't have one
+    if sheet_data and len(sheet_data[0]) == retrain.SOURCE_COLUMN:
+        sheet_data[0].append('Source')
+
     # Add a row number as the first column (skip the header row)
     for idx, row in enumerate(sheet_data[1:], start=1):  # Skip header, start from 1
         row.insert(0, idx)  # Insert the row number at the beginning of each row
 
     # Add "Row Number" to the header
-    sheet_data[0].insert(0, "Row Number")
+    if sheet_data:
+        sheet_data[0].insert(0, "Row Number")
 
     # Pass the updated sheet data to the HTML template
     return render_template('view_sheet.html', sheet_data=sheet_data)
 
 
+# Route for the data-quality report
+@app.route('/quality')
+@cached_page()
+def data_quality():
+    values = get_data_from_google_sheets()
+    quality = get_data_quality(values)
+
+    inconsistent = [
+        {'column': group, 'count': int(mask.sum()), 'rows': quality.rows_where(mask)}
+        for group, mask in quality.inconsistent.items()
+    ]
+
+    return render_template('quality.html',
+                           row_count=len(quality.row_numbers),
+                           blank_count=int(quality.blank.sum()),
+                           columns=quality.column_report(),
+                           short_count=int(quality.short.sum()),
+                           short_rows=quality.rows_where(quality.short),
+                           row_width=ROW_WIDTH,
+                           invalid_outcome_count=int(quality.invalid_outcome.sum()),
+                           invalid_outcome_rows=quality.rows_where(quality.invalid_outcome),
+                           inconsistent=inconsistent)
+
+# Sheets request counters and quota headroom for this worker
+@app.route('/sheets_stats')
+def sheets_stats():
+    return jsonify(sheets_client.quota_stats())
 
 @app.route('/d')
+@cached_page()
 def index2():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -741,6 +1469,7 @@ def index2():
     return render_template('diabetesprevalence.html', age_groups=age_groups, diabetes_prevalence=diabetes_prevalence)
 
 @app.route('/a')
+@cached_page()
 def average_insulin():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -752,6 +1481,7 @@ def average_insulin():
     return render_template('insulinbyagegroup.html', age_groups=age_groups, avg_insulin=avg_insulin)
 
 @app.route('/b')
+@cached_page()
 def average_blood_pressure():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -763,6 +1493,7 @@ def average_blood_pressure():
     return render_template('averagebloodpressure.html', age_groups=age_groups, avg_blood_pressure=avg_blood_pressure)
 
 @app.route('/s')
+@cached_page()
 def average_skin_thickness():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -774,6 +1505,7 @@ def average_skin_thickness():
     return render_template('averageskinthickness.html', age_groups=age_groups, avg_skin_thickness=avg_skin_thickness)
 
 @app.route('/g')
+@cached_page()
 def average_glucose():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -786,6 +1518,7 @@ def average_glucose():
 
 
 @app.route('/p')
+@cached_page()
 def average_pedigree():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -797,6 +1530,7 @@ def average_pedigree():
     return render_template('averagepedigree.html', age_groups=age_groups, avg_pedigree=avg_pedigree)
 
 @app.route('/pr')
+@cached_page()
 def pregnancies_pie():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -808,6 +1542,7 @@ def pregnancies_pie():
     return render_template('pregnanciespie.html', outcomes=outcomes, pregnancies_counts=pregnancies_counts)
 
 @app.route('/st')
+@cached_page()
 def stacked_bar():
     # Get data from Google Sheets
     values = get_data_from_google_sheets()
@@ -818,5 +1553,28 @@ def stacked_bar():
     # Pass data to the template for stacked bar chart
     return render_template('stackedbar.html', bmi_classes=bmi_classes, outcome_0_counts=outcome_0_counts, outcome_1_counts=outcome_1_counts)
 
+@app.route('/distribution')
+@cached_page(column=NUMERIC_COLUMNS, group_by=GROUP_COLUMNS)
+def distribution():
+    column = request.args.get('column', 'Glucose')
+    group_by = request.args.get('group_by', 'AgeGroup')
+    if column not in NUMERIC_COLUMNS:
+        column = 'Glucose'
+    if group_by not in GROUP_COLUMNS:
+        group_by = 'AgeGroup'
+
+    # Histogram and p10/p50/p90 per group, served from the sketches
+    groups, bin_labels, group_counts, percentiles = process_distribution_data(column, group_by)
+
+    return render_template('distribution.html',
+                           column=column,
+                           group_by=group_by,
+                           columns=list(NUMERIC_COLUMNS),
+                           group_columns=list(GROUP_COLUMNS),
+                           groups=groups,
+                           bin_labels=bin_labels,
+                           group_counts=group_counts,
+                           percentiles=percentiles)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
\ No newline at end of file
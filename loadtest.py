@@ -0,0 +1,365 @@
+"""Load test for the dashboard against a local stand-in for the Google Sheets API.
+
+Starts a fake Sheets v4 `values` server with configurable latency, payload size
+and injected 429/5xx errors, runs the app under gunicorn against it for each
+worker/thread/worker-class setting, drives mixed traffic and reports
+throughput, latency percentiles and error rates per route.
+
+Example:
+    python loadtest.py --configs 2x4:gthread 4x1:sync --duration 30 --concurrency 16 \\
+        --rows 2000 --read-latency lognormal:120,0.5 --error-429 0.02
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import numpy as np
+import requests
+
+HEADER = ['Pregnancies', 'Glucose', 'BloodPressure', 'SkinThickness', 'Insulin', 'BMI',
+          'DiabetesPedigreeFunction', 'Age', 'Outcome', 'AgeGroup', 'BMIClass']
+
+CHART_ROUTES = ['/d', '/a', '/b', '/s', '/g', '/p', '/pr', '/st', '/distribution']
+
+# Default traffic mix, as relative weights per route
+DEFAULT_MIX = {'/': 40, 'charts': 30, '/view': 10, '/add': 10, '/predict': 10}
+
+
+def age_group(age):
+    for low in range(20, 70, 10):
+        if low <= age < low + 10:
+            return f'{low}-{low + 10}'
+    return 'Others'
+
+
+def bmi_class(bmi):
+    if bmi < 18.5:
+        return 'Underweight'
+    elif bmi < 24.9:
+        return 'Healthy'
+    elif 25 <= bmi < 29.9:
+        return 'Overweight'
+    return 'Obese'
+
+
+def random_patient(rng):
+    return {
+        'pregnancies': rng.randint(0, 12),
+        'glucose': rng.randint(60, 199),
+        'blood_pressure': rng.randint(40, 120),
+        'skin_thickness': rng.randint(0, 60),
+        'insulin': rng.choice([0, 50, 100, 200, 400]),
+        'bmi': round(rng.uniform(15, 50), 1),
+        'diabetes_pedigree_function': round(rng.uniform(0.08, 2.4), 3),
+        'age': rng.randint(21, 80),
+        'outcome': str(rng.randint(0, 1)),
+    }
+
+
+# Synthetic sheet with a header row, shaped like the real dataset
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    rows = [list(HEADER)]
+    for _ in range(count):
+        p = random_patient(rng)
+        rows.append([str(p['pregnancies']), str(p['glucose']), str(p['blood_pressure']),
+                     str(p['skin_thickness']), str(p['insulin']), str(p['bmi']),
+                     str(p['diabetes_pedigree_function']), str(p['age']), p['outcome'],
+                     age_group(p['age']), bmi_class(p['bmi'])])
+    return rows
+
+
+# Parse a latency spec into a function returning a delay in seconds.
+# Specs are in milliseconds: none, fixed:MS, uniform:LO,HI, exp:MEAN, lognormal:MEDIAN,SIGMA
+def parse_latency(spec):
+    kind, _, args = spec.partition(':')
+    params = [float(a) for a in args.split(',')] if args else []
+    if kind == 'none':
+        return lambda: 0.0
+    if kind == 'fixed':
+        return lambda: params[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(params[0], params[1]) / 1000
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / params[0]) / 1000
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(np.log(params[0]), params[1]) / 1000
+    raise argparse.ArgumentTypeError(f'Unknown latency spec: {spec}')
+
+
+# Local stand-in for the Sheets v4 spreadsheets.values endpoints used by app.py
+class SheetsStandIn:
+    def __init__(self, rows, read_latency, write_latency, error_429=0.0, error_5xx=0.0):
+        self.rows = rows
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+        self.server = None
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    # Returns the 1-based row number for an 'A5:K5' style range, None for the whole sheet
+    @staticmethod
+    def row_number(range_name):
+        match = re.search(r'!A(\d+)', range_name)
+        return int(match.group(1)) if match else None
+
+    def handle(self, method, path, body):
+        match = re.match(r'/v4/spreadsheets/[^/]+/values/([^:?]+)(?::(append|clear))?', unquote(path))
+        if not match:
+            return 404, {'error': {'code': 404, 'message': 'Not found'}}
+        range_name, action = match.groups()
+        kind = 'read' if method == 'GET' else 'write'
+
+        time.sleep((self.read_latency if kind == 'read' else self.write_latency)())
+
+        # Injected quota and server errors
+        roll = random.random()
+        if roll < self.error_429:
+            self.stats['injected_429'] += 1
+            return 429, {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}}
+        if roll < self.error_429 + self.error_5xx:
+            self.stats['injected_5xx'] += 1
+            return 503, {'error': {'code': 503, 'message': 'Service unavailable', 'status': 'UNAVAILABLE'}}
+
+        self.stats[kind] += 1
+        row_number = self.row_number(range_name)
+        with self.lock:
+            if method == 'GET':
+                if row_number is None:
+                    return 200, {'range': range_name, 'values': [list(row) for row in self.rows]}
+                if row_number <= len(self.rows) and self.rows[row_number - 1]:
+                    return 200, {'range': range_name, 'values': [list(self.rows[row_number - 1])]}
+                return 200, {'range': range_name}
+            if action == 'append':
+                self.rows.append([str(v) for v in body['values'][0]])
+                row = len(self.rows)
+                return 200, {'updates': {'updatedRange': f'{range_name}!A{row}:K{row}', 'updatedRows': 1}}
+            if action == 'clear':
+                if row_number is not None and row_number <= len(self.rows):
+                    self.rows[row_number - 1] = []
+                return 200, {'clearedRange': range_name}
+            if method == 'PUT' and row_number is not None:
+                while len(self.rows) < row_number:
+                    self.rows.append([])
+                self.rows[row_number - 1] = [str(v) for v in body['values'][0]]
+                return 200, {'updatedRows': 1}
+        return 400, {'error': {'code': 400, 'message': 'Unsupported request'}}
+
+    def make_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'null') if length else None
+                status, payload = stand_in.handle(self.command, urlparse(self.path).path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Start the app under gunicorn with the given worker settings, pointed at the stand-in.
+# The app gets a copy of the model in a temporary directory, since /add traffic
+# triggers retrains on the synthetic rows that must never replace the real model.
+def start_app(workers, threads, worker_class, sheets_url, port):
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp()
+    model_path = shutil.copy(os.path.join(app_dir, 'logistic_regression_model.pkl'), work_dir)
+    env = dict(os.environ,
+               SHEETS_API_ENDPOINT=sheets_url,
+               SPREADSHEET_ID='loadtest',
+               WEB_CONCURRENCY=str(workers),  # Splits the Sheets quota between the workers
+               DATA_VERSION_FILE=os.path.join(work_dir, 'data_version'),
+               MODEL_PATH=model_path)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app',
+         '--bind', f'127.0.0.1:{port}',
+         '--workers', str(workers),
+         '--threads', str(threads),
+         '--worker-class', worker_class,
+         '--log-level', 'warning'],
+        cwd=app_dir,
+        env=env)
+
+    # Wait until the app answers
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {process.returncode}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/predict', timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def csrf_token(html):
+    match = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', html)
+    return match.group(1) if match else ''
+
+
+def pick_route(rng, mix):
+    route = rng.choices(list(mix), weights=list(mix.values()))[0]
+    return rng.choice(CHART_ROUTES) if route == 'charts' else route
+
+
+# Drive traffic from `concurrency` client threads for `duration` seconds
+def run_traffic(base_url, mix, concurrency, duration, seed=0):
+    samples = []
+    samples_lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def record(label, started, ok):
+        with samples_lock:
+            samples.append((label, time.monotonic() - started, ok))
+
+    def request(session, label, method, url, **kwargs):
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, timeout=30, allow_redirects=False, **kwargs)
+            record(label, started, response.status_code < 400)
+            return response
+        except requests.RequestException:
+            record(label, started, False)
+            return None
+
+    def client(index):
+        rng = random.Random(seed + index)
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            route = pick_route(rng, mix)
+            response = request(session, f'GET {route}', 'GET', base_url + route)
+            if route in ('/add', '/predict') and response is not None and response.ok:
+                form = random_patient(rng)
+                form['csrf_token'] = csrf_token(response.text)
+                if route == '/predict':
+                    del form['outcome']
+                request(session, f'POST {route}', 'POST', base_url + route, data=form)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.monotonic() - started
+
+
+def report(config, samples, elapsed, stand_in):
+    by_label = defaultdict(list)
+    for label, latency, ok in samples:
+        by_label[label].append((latency, ok))
+    by_label['TOTAL'] = [(latency, ok) for _, latency, ok in samples]
+
+    print(f'\n== {config}  ({len(samples)} requests in {elapsed:.1f}s)')
+    print(f'{"route":<22}{"count":>8}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"errors":>9}')
+    for label in sorted(by_label, key=lambda l: (l == 'TOTAL', l)):
+        latencies = np.array([latency for latency, _ in by_label[label]]) * 1000
+        errors = sum(1 for _, ok in by_label[label] if not ok)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f'{label:<22}{len(latencies):>8}{len(latencies) / elapsed:>9.1f}'
+              f'{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{errors / len(latencies):>8.1%}')
+    print(f'Sheets stand-in: {dict(stand_in.stats)}')
+
+
+def parse_config(spec):
+    # WORKERSxTHREADS[:CLASS], e.g. 4x2:gthread
+    match = re.fullmatch(r'(\d+)x(\d+)(?::(\w+))?', spec)
+    if not match:
+        raise argparse.ArgumentTypeError(f'Expected WORKERSxTHREADS[:CLASS], got {spec}')
+    workers, threads, worker_class = match.groups()
+    return int(workers), int(threads), worker_class or ('gthread' if int(threads) > 1 else 'sync')
+
+
+def parse_mix(spec):
+    # route=weight pairs, e.g. /=40,charts=30,/view=10,/add=10,/predict=10
+    mix = {}
+    for part in spec.split(','):
+        route, _, weight = part.partition('=')
+        mix[route] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dashboard against a local Sheets stand-in.')
+    parser.add_argument('--configs', nargs='+', type=parse_config, default=[parse_config('1x1:sync')],
+                        help='gunicorn settings to compare, as WORKERSxTHREADS[:CLASS]')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of traffic per config')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='traffic mix as route=weight pairs; "charts" picks a random chart route')
+    parser.add_argument('--rows', type=int, default=768, help='rows in the simulated sheet')
+    parser.add_argument('--read-latency', type=parse_latency, default=parse_latency('lognormal:100,0.4'),
+                        help='Sheets read latency in ms: none, fixed:MS, uniform:LO,HI, exp:MEAN, lognormal:MEDIAN,SIGMA')
+    parser.add_argument('--write-latency', type=parse_latency, default=parse_latency('lognormal:200,0.4'),
+                        help='Sheets write latency, same format as --read-latency')
+    parser.add_argument('--error-429', type=float, default=0.0, help='fraction of Sheets calls answered with 429')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='fraction of Sheets calls answered with 503')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for workers, threads, worker_class in args.configs:
+        # Fresh sheet per config so every run starts from the same data
+        stand_in = SheetsStandIn(make_rows(args.rows, args.seed), args.read_latency, args.write_latency,
+                                 args.error_429, args.error_5xx)
+        sheets_url = stand_in.start()
+        port = free_port()
+        app_process = start_app(workers, threads, worker_class, sheets_url, port)
+        try:
+            stand_in.stats.clear()
+            samples, elapsed = run_traffic(f'http://127.0.0.1:{port}', args.mix, args.concurrency,
+                                           args.duration, args.seed)
+            report(f'{workers} workers x {threads} threads ({worker_class})', samples, elapsed, stand_in)
+        finally:
+            app_process.terminate()
+            app_process.wait()
+            stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
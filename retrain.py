@@ -0,0 +1,172 @@
+# Retraining for the diabetes prediction model. This module is kept free of
+# Flask and Google imports so the background process that runs it stays light.
+import fcntl
+import json
+import os
+import tempfile
+import time
+import warnings
+
+import joblib
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+
+# Sheet columns used as model features: Glucose, BloodPressure, SkinThickness,
+# Insulin, BMI, DiabetesPedigreeFunction
+FEATURE_COLUMNS = [1, 2, 3, 4, 5, 6]
+OUTCOME_COLUMN = 8
+
+# Rows added by /predict carry the model's own prediction as their Outcome and
+# are marked with PREDICTION_SOURCE in the Source column. They are not labels,
+# so they are kept out of both training and the holdout.
+SOURCE_COLUMN = 11
+PREDICTION_SOURCE = 'prediction'
+
+# Min-max ranges of the features, must match preprocess_input_forlogisticregression
+FEATURE_MIN = np.array([0, 0, 0, 0, 0.0, 0.0])
+FEATURE_MAX = np.array([200, 200, 100, 1000, 100.0, 3.0])
+
+# Every HOLDOUT_EVERY-th row is held out, so the split is stable as rows are appended
+HOLDOUT_EVERY = 5
+
+# A full refit may score at most this much below the current model on the
+# holdout. A full refit depends only on the rows, so the slack can't add up
+# across runs. An incremental update starts from the current model, and the
+# slack would compound with every accept, so it must not score lower at all.
+ACCEPT_TOLERANCE = 0.01
+
+MIN_TRAINING_ROWS = 20
+
+
+def parse_float(cell):
+    try:
+        return float(cell)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+_parse_floats = np.frompyfunc(parse_float, 1, 1)
+
+
+# Function to turn the sheet rows (header first) into a float matrix of the
+# numeric columns Pregnancies..Outcome, with NaN for missing or invalid cells
+def numeric_matrix(values, width=OUTCOME_COLUMN + 1):
+    rows = values[1:]
+    cells = np.full((len(rows), width), '', dtype=object)
+    for i, row in enumerate(rows):
+        row = row[:width]
+        cells[i, :len(row)] = row
+    return _parse_floats(cells).astype(float)
+
+
+# Function to build the normalized feature matrix and labels from the sheet rows.
+# Returns X, y and the sheet row index of each sample (0 is the first data row).
+def build_feature_matrix(values):
+    matrix = numeric_matrix(values)
+    X = matrix[:, FEATURE_COLUMNS]
+    y = matrix[:, OUTCOME_COLUMN]
+
+    # Drop blank or invalid rows, and rows whose outcome was predicted
+    sources = np.array([row[SOURCE_COLUMN] if len(row) > SOURCE_COLUMN else '' for row in values[1:]], dtype=object)
+    valid = ~np.isnan(X).any(axis=1) & np.isin(y, (0, 1)) & (sources != PREDICTION_SOURCE)
+    X = np.clip((X[valid] - FEATURE_MIN) / (FEATURE_MAX - FEATURE_MIN), 0, 1)
+    return X, y[valid].astype(int), np.flatnonzero(valid)
+
+
+def metadata_path(model_path):
+    return model_path + '.json'
+
+
+def load_metadata(model_path):
+    try:
+        with open(metadata_path(model_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Write to a temporary file and rename it over the target, so readers never
+# see a partially written file
+def atomic_write(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def fit_full(X, y):
+    return LogisticRegression(max_iter=1000).fit(X, y)
+
+
+# One SGD pass over the new rows, starting from the current coefficients.
+# SGD trains its initial arrays in place, so it gets copies and the current
+# model is left untouched.
+def fit_incremental(current, X, y):
+    model = SGDClassifier(loss='log_loss', learning_rate='constant', eta0=0.01, max_iter=1, tol=None)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        model.fit(X, y, coef_init=current.coef_.copy(), intercept_init=current.intercept_.copy())
+    return model
+
+
+# Retrain the model from the sheet rows and replace the file at model_path if
+# the new model does at least as well on the holdout. mode is 'full' to refit
+# on every row or 'incremental' to update on rows added since the last run.
+# Returns a report of what happened.
+def retrain(values, model_path, mode='incremental'):
+    report = {'mode': mode, 'started_at': time.time(), 'accepted': False}
+
+    # Only one retrain at a time across all workers
+    with open(model_path + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            report['reason'] = 'another retrain is running'
+            return report
+
+        X, y, row_index = build_feature_matrix(values)
+        holdout = row_index % HOLDOUT_EVERY == 0
+        metadata = load_metadata(model_path)
+        current = joblib.load(model_path)
+
+        train = ~holdout
+        if mode == 'incremental':
+            # Only rows appended since the model was last trained
+            train &= row_index >= metadata.get('trained_rows', 0)
+
+        report['training_rows'] = int(train.sum())
+        report['holdout_rows'] = int(holdout.sum())
+        if train.sum() < MIN_TRAINING_ROWS or len(np.unique(y[train])) < 2 or holdout.sum() == 0:
+            report['reason'] = 'not enough new labeled rows'
+            return report
+
+        # Score the deployed model before anything else can touch it
+        report['current_accuracy'] = round(float(current.score(X[holdout], y[holdout])), 4)
+
+        if mode == 'incremental':
+            candidate = fit_incremental(current, X[train], y[train])
+        else:
+            candidate = fit_full(X[train], y[train])
+
+        report['candidate_accuracy'] = round(float(candidate.score(X[holdout], y[holdout])), 4)
+        tolerance = ACCEPT_TOLERANCE if mode == 'full' else 0
+        if report['candidate_accuracy'] < report['current_accuracy'] - tolerance:
+            report['reason'] = 'candidate did worse on the holdout'
+            return report
+
+        metadata = {
+            'trained_rows': int(len(values) - 1),
+            'mode': mode,
+            'holdout_accuracy': report['candidate_accuracy'],
+            'trained_at': time.time(),
+        }
+        atomic_write(model_path, lambda f: joblib.dump(candidate, f))
+        atomic_write(metadata_path(model_path), lambda f: f.write(json.dumps(metadata).encode()))
+        report['accepted'] = True
+        return report